@@ -1,20 +1,43 @@
 """This script creates Trello cards based on definitions"""
 
 import argparse
+import hashlib
+import heapq
 import json
-from dataclasses import dataclass
+import pickle
+import sqlite3
+from concurrent.futures import Executor
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import date
 from datetime import datetime
 from datetime import time
 from datetime import timedelta
 from datetime import timezone
+from functools import cache
 from pathlib import Path
+from typing import Iterable
+from typing import Iterator
+from typing import NamedTuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads  # type: ignore[assignment]
 
-@dataclass
-class Rule:
+MAX_WORKERS = 8
+RULES_CACHE_VERSION = 2
+CACHE_DIRPATH = Path("~/.cache/recurrent_tasks").expanduser()
+ETAGS_FILEPATH = CACHE_DIRPATH / "etags.json"
+RULES_CACHE_DIRPATH = CACHE_DIRPATH / "rules"
+POSTED_FILEPATH = CACHE_DIRPATH / "posted.sqlite"
+
+
+class Rule(NamedTuple):
     """A rule for creating a recurrent task"""
 
     card_name: str
@@ -26,8 +49,7 @@ class Rule:
     due_in: int | None
 
 
-@dataclass
-class Card:
+class Card(NamedTuple):
     """A Trello Card"""
 
     name: str
@@ -36,6 +58,39 @@ class Card:
     due_reminder: int | None = None
 
 
+RuleIndex = dict[tuple[int | None, int | None], list[tuple[int, Rule]]]
+
+
+def build_index(rules: list[Rule]) -> RuleIndex:
+    """Group rules and their positions by their (month, weekday) constraints"""
+
+    index: RuleIndex = {}
+    for position, rule in enumerate(rules):
+        index.setdefault((rule.month, rule.weekday), []).append((position, rule))
+
+    return index
+
+
+def find_rules(rule_index: RuleIndex, evaluation_date: date) -> Iterator[Rule]:
+    """Get the indexed rules allowing an evaluation date, in their file order"""
+
+    month = evaluation_date.month
+    weekday = evaluation_date.weekday()
+    buckets = [
+        rule_index.get(key, [])
+        for key in ((None, None), (None, weekday), (month, None), (month, weekday))
+    ]
+
+    return (rule for _, rule in heapq.merge(*buckets))
+
+
+@cache
+def get_due(due_date: date, due_time: time) -> datetime:
+    """Get a timezone-aware due datetime in the local timezone"""
+
+    return datetime.combine(due_date, due_time).astimezone()
+
+
 def get_cards(
     rules: list[Rule],
     evaluation_date: date,
@@ -45,23 +100,80 @@ def get_cards(
 ) -> list[Card]:
     """Get cards from rules at an evaluation date"""
 
+    return get_cards_for_dates(
+        rules, [evaluation_date], due_time=due_time, due_reminder=due_reminder
+    )
+
+
+def get_cards_for_dates(
+    rules: list[Rule],
+    evaluation_dates: Iterable[date],
+    *,
+    due_time: time = time(9, 0, 0),
+    due_reminder: int | None = 1440,
+) -> list[Card]:
+    """Get cards from rules at several evaluation dates"""
+
+    rule_index = build_index(rules)
+
     cards: list[Card] = []
-    for rule in rules:
-        if rule.year is not None and rule.year != evaluation_date.year:
-            continue
-        if rule.month is not None and rule.month != evaluation_date.month:
+    for evaluation_date in evaluation_dates:
+        cards.extend(
+            get_indexed_cards(
+                rule_index,
+                evaluation_date,
+                due_time=due_time,
+                due_reminder=due_reminder,
+            )
+        )
+
+    return cards
+
+
+def unique_cards(cards: list[Card]) -> list[Card]:
+    """Keep only the earliest date's card for each list and card name"""
+
+    seen: set[tuple[str, str]] = set()
+    unique: list[Card] = []
+    for card in cards:
+        key = (card.list_id, card.name)
+        if key not in seen:
+            seen.add(key)
+            unique.append(card)
+
+    return unique
+
+
+def get_indexed_cards(
+    rule_index: RuleIndex,
+    evaluation_date: date,
+    *,
+    due_time: time,
+    due_reminder: int | None,
+) -> list[Card]:
+    """Get cards from indexed rules at an evaluation date, first rule winning"""
+
+    year = evaluation_date.year
+    day = evaluation_date.day
+
+    cards: list[Card] = []
+    seen: set[tuple[str, str]] = set()
+    for rule in find_rules(rule_index, evaluation_date):
+        rule_year = rule.year
+        if rule_year is not None and rule_year != year:
             continue
-        if rule.day is not None and rule.day != evaluation_date.day:
+        rule_day = rule.day
+        if rule_day is not None and rule_day != day:
             continue
-        if rule.weekday is not None and rule.weekday != evaluation_date.weekday():
+        key = (rule.list_id, rule.card_name)
+        if key in seen:
             continue
+        seen.add(key)
 
         card_due = (
             None
             if rule.due_in is None
-            else datetime.combine(
-                evaluation_date + timedelta(days=rule.due_in), due_time
-            )
+            else get_due(evaluation_date + timedelta(days=rule.due_in), due_time)
         )
 
         cards.append(Card(rule.card_name, rule.list_id, card_due, due_reminder))
@@ -69,41 +181,298 @@ def get_cards(
     return cards
 
 
+def load_etags() -> dict[str, tuple[str, set[str]]]:
+    """Load cached list ETags and the card names they correspond to"""
+
+    try:
+        return {
+            list_id: (entry["etag"], set(entry["names"]))
+            for list_id, entry in loads(ETAGS_FILEPATH.read_bytes()).items()
+        }
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return {}
+
+
+def save_etags(etags: dict[str, tuple[str, set[str]]]) -> None:
+    """Save list ETags and the card names they correspond to"""
+
+    entries = {
+        list_id: {"etag": etag, "names": sorted(names)}
+        for list_id, (etag, names) in etags.items()
+    }
+    try:
+        ETAGS_FILEPATH.parent.mkdir(parents=True, exist_ok=True)
+        ETAGS_FILEPATH.write_text(json.dumps(entries), encoding="UTF-8")
+    except OSError:
+        pass
+
+
+def fetch_card_names(
+    session: requests.Session,
+    list_id: str,
+    auth: dict[str, str],
+    *,
+    cached: tuple[str, set[str]] | None = None,
+    timeout: int = 60,
+) -> tuple[str | None, set[str]]:
+    """Get a list's ETag and card names, reusing cached names if unchanged"""
+
+    url = f"https://api.trello.com/1/lists/{list_id}/cards"
+    query = {**auth, "fields": "name"}
+    headers = {} if cached is None else {"If-None-Match": cached[0]}
+    response = session.get(url, params=query, headers=headers, timeout=timeout)
+    if response.status_code == 304 and cached is not None:
+        return cached
+    if response.status_code != 200:
+        raise RuntimeError(f"Couldn't get card lista for {list_id}")
+
+    names = {card["name"] for card in loads(response.content)}
+
+    return response.headers.get("ETag"), names
+
+
+def store_card_names(
+    etags: dict[str, tuple[str, set[str]]],
+    results: Iterable[tuple[str, tuple[str | None, set[str]]]],
+) -> dict[str, set[str]]:
+    """Record fetched card names in the ETag cache and group them by list"""
+
+    card_names = {}
+    for list_id, (etag, names) in results:
+        card_names[list_id] = names
+        if etag is None:
+            etags.pop(list_id, None)
+        else:
+            etags[list_id] = (etag, names)
+    save_etags(etags)
+
+    return card_names
+
+
+def load_posted(posted_date: date) -> dict[str, set[str]]:
+    """Load the names of cards created on a date, by list"""
+
+    posted: dict[str, set[str]] = {}
+    try:
+        with closing(sqlite3.connect(POSTED_FILEPATH)) as connection:
+            rows = connection.execute(
+                "SELECT list_id, name FROM posted WHERE date = ?",
+                (posted_date.isoformat(),),
+            ).fetchall()
+    except sqlite3.Error:
+        return posted
+
+    for list_id, name in rows:
+        posted.setdefault(list_id, set()).add(name)
+
+    return posted
+
+
+def save_posted(posted_date: date, cards: list[Card]) -> None:
+    """Record cards created on a date, forgetting dates before it and today"""
+
+    try:
+        POSTED_FILEPATH.parent.mkdir(parents=True, exist_ok=True)
+        with closing(sqlite3.connect(POSTED_FILEPATH)) as connection:
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS posted (date TEXT, list_id TEXT, "
+                    "name TEXT, PRIMARY KEY (date, list_id, name))"
+                )
+                connection.execute(
+                    "DELETE FROM posted WHERE date < ?",
+                    (min(posted_date, date.today()).isoformat(),),
+                )
+                connection.executemany(
+                    "INSERT OR IGNORE INTO posted VALUES (?, ?, ?)",
+                    [
+                        (posted_date.isoformat(), card.list_id, card.name)
+                        for card in cards
+                    ],
+                )
+    except (OSError, sqlite3.Error):
+        pass
+
+
+def post_card(
+    session: requests.Session, query: dict[str, str], *, timeout: int = 60
+) -> bool:
+    """Create a card from its query, reporting whether it was created"""
+
+    try:
+        response = session.post(
+            "https://api.trello.com/1/cards", params=query, timeout=timeout
+        )
+    except requests.RequestException:
+        return False
+
+    return response.status_code == 200
+
+
+def post_cards(
+    executor: Executor,
+    session: requests.Session,
+    cards: list[tuple[Card, str | None]],
+    auth: dict[str, str],
+    *,
+    timeout: int = 60,
+) -> list[tuple[Card, bool]]:
+    """Create cards paired with their UTC ISO due strings, reporting successes"""
+
+    queries = []
+    for card, due_iso in cards:
+        query = {"idList": card.list_id, "name": card.name, **auth}
+        if due_iso is not None:
+            query["due"] = due_iso
+        if card.due_reminder is not None:
+            query["dueReminder"] = str(card.due_reminder)
+        queries.append(query)
+
+    results = executor.map(
+        lambda query: post_card(session, query, timeout=timeout), queries
+    )
+
+    return [(card, created) for (card, _), created in zip(cards, results)]
+
+
+def create_session() -> requests.Session:
+    """Create a pooled session that retries requests which are safe to repeat"""
+
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=MAX_WORKERS,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET"],
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            ),
+        ),
+    )
+    # A card may already exist after a timeout or gateway error, so card
+    # creation is only retried on connection errors and rate limiting
+    session.mount(
+        "https://api.trello.com/1/cards",
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=MAX_WORKERS,
+            max_retries=Retry(
+                total=5,
+                read=0,
+                other=0,
+                backoff_factor=0.5,
+                status_forcelist=[429],
+                allowed_methods=["POST"],
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            ),
+        ),
+    )
+
+    return session
+
+
 def create_cards(
     cards: list[Card],
     api_key: str,
     token: str,
     *,
+    run_date: date,
     timeout: int = 60,
 ) -> None:
     """Create cards from a list if they don't already exist"""
 
-    current_card_names = {}
-    for list_id in set(card.list_id for card in cards):
-        url = f"https://api.trello.com/1/lists/{list_id}/cards"
-        query = {"key": api_key, "token": token}
-        response = requests.get(url, params=query, timeout=timeout)
-        if response.status_code != 200:
-            raise RuntimeError(f"Couldn't get card lista for {list_id}")
-        current_card_names[list_id] = [card["name"] for card in response.json()]
+    with create_session() as session:
+        auth = {"key": api_key, "token": token}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            etags = load_etags()
+            posted = load_posted(run_date)
+            results = executor.map(
+                lambda list_id: (
+                    list_id,
+                    fetch_card_names(
+                        session,
+                        list_id,
+                        auth,
+                        cached=etags.get(list_id),
+                        timeout=timeout,
+                    ),
+                ),
+                {
+                    card.list_id
+                    for card in cards
+                    if card.name not in posted.get(card.list_id, set())
+                },
+            )
 
-    url = "https://api.trello.com/1/cards"
-    for card in cards:
-        if card.name in current_card_names:
-            continue
-        query = {
-            "idList": card.list_id,
-            "name": card.name,
-            "key": api_key,
-            "token": token,
-        }
-        if card.due is not None:
-            query["due"] = card.due.astimezone(timezone.utc).isoformat()
-        if card.due_reminder is not None:
-            query["dueReminder"] = str(card.due_reminder)
-        response = requests.post(url, params=query, timeout=timeout)
-        if response.status_code != 200:
-            raise RuntimeError(f"Couldn't create card {card}")
+            due_isos = [
+                (
+                    None
+                    if card.due is None
+                    else card.due.astimezone(timezone.utc).isoformat()
+                )
+                for card in cards
+            ]
+
+            current_card_names = store_card_names(etags, results)
+
+            outcomes = post_cards(
+                executor,
+                session,
+                [
+                    (card, due_iso)
+                    for card, due_iso in zip(cards, due_isos)
+                    if card.name not in posted.get(card.list_id, set())
+                    and card.name not in current_card_names[card.list_id]
+                ],
+                auth,
+                timeout=timeout,
+            )
+
+            save_posted(run_date, [card for card, created in outcomes if created])
+            failed = [card for card, created in outcomes if not created]
+            if failed:
+                raise RuntimeError(f"Couldn't create card {failed[0]}")
+
+
+def load_rules(rules_filepath: Path) -> list[Rule]:
+    """Load rules from a JSON file, reusing a pickled copy if it is current"""
+
+    stat = rules_filepath.stat()
+    key = (RULES_CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+    path_hash = hashlib.sha256(str(rules_filepath.resolve()).encode()).hexdigest()
+    cache_filepath = RULES_CACHE_DIRPATH / f"{path_hash}.pkl"
+
+    try:
+        with cache_filepath.open("rb") as cache_file:
+            cached_key, cached_rules = pickle.load(cache_file)
+        if cached_key == key:
+            return cached_rules
+    except (
+        OSError,
+        EOFError,
+        pickle.UnpicklingError,
+        AttributeError,
+        ValueError,
+        TypeError,
+    ):
+        pass
+
+    rules = [Rule(**rule) for rule in loads(rules_filepath.read_bytes())]
+
+    try:
+        RULES_CACHE_DIRPATH.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with cache_filepath.open("wb") as cache_file:
+            pickle.dump((key, rules), cache_file)
+    except OSError:
+        pass
+
+    return rules
 
 
 def parse_args() -> argparse.Namespace:
@@ -119,8 +488,32 @@ def parse_args() -> argparse.Namespace:
         type=Path,
         help="Path to a JSON file containing an API key and a token",
     )
+    parser.add_argument(
+        "--date",
+        type=date.fromisoformat,
+        default=date.today(),
+        help="First evaluation date (YYYY-MM-DD), defaults to today",
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=1,
+        help=(
+            "Number of consecutive evaluation dates, defaults to 1; a card "
+            "recurring within them is only created for its first date"
+        ),
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the cards of every evaluation date instead of creating them",
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.days < 1:
+        parser.error("--days must be at least 1")
+
+    return args
 
 
 def main() -> None:
@@ -128,15 +521,20 @@ def main() -> None:
 
     args = parse_args()
 
-    with args.rules_filepath.open(encoding="UTF-8") as rules_file:
-        rules = [Rule(**rule) for rule in json.load(rules_file)]
-    with args.secrets_filepath.open(encoding="UTF-8") as secrets_file:
-        secrets = json.load(secrets_file)
-        api_key = secrets["api_key"]
-        token = secrets["token"]
+    rules = load_rules(args.rules_filepath)
+    evaluation_dates = [args.date + timedelta(days=days) for days in range(args.days)]
+    cards = get_cards_for_dates(rules, evaluation_dates)
+
+    if args.dry_run:
+        for card in cards:
+            print(card)
+        return
+
+    secrets = loads(args.secrets_filepath.read_bytes())
+    api_key = secrets["api_key"]
+    token = secrets["token"]
 
-    cards = get_cards(rules, date.today())
-    create_cards(cards, api_key, token)
+    create_cards(unique_cards(cards), api_key, token, run_date=args.date)
 
 
 if __name__ == "__main__":